@@ -1,29 +1,103 @@
 import os
-from flask import Flask, send_from_directory, request, jsonify, send_file
+from flask import Flask, Request, abort, send_from_directory, request, jsonify, send_file
 from flask_cors import CORS
 import logging
+import shutil
+import subprocess
 import tempfile
+import threading
+import time
 import uuid
+from collections import OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass, field
+from werkzeug.exceptions import HTTPException
 from werkzeug.utils import secure_filename
 import pikepdf
-from PyPDF2 import PdfReader, PdfWriter
 import io
 
 # Configure logging
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
+# Configuration
+MAX_CONTENT_LENGTH = 500 * 1024 * 1024  # 500MB
+# Uploads and compressed output are written here. Set PDFC_TEMP to a disk-backed
+# directory when the system temp dir is a small RAM-backed tmpfs.
+TEMP_FOLDER = os.environ.get('PDFC_TEMP', tempfile.gettempdir())
+WRITE_BUFFER_SIZE = 1 << 20  # 1MB, instead of Python's 8KB default
+MAX_TRACKED_TASKS = 1024  # oldest tasks beyond this are evicted with their files
+TASK_TTL = 60 * 60  # seconds; tasks unused for this long are evicted with their files
+
+# Compression passes chosen by target size / original size
+LOSSLESS_RATIO = 0.85  # above this a plain repack may be enough
+RECOMPRESS_RATIO = 0.3  # above this recompressing Flate streams may be enough
+IMAGE_QUALITIES = [75, 60, 45, 30]  # JPEG qualities tried when re-encoding images
+QPDF_BINARY = shutil.which('qpdf')  # optional; pikepdf is used when it is missing
+QPDF_TIMEOUT = 30  # seconds
+
+# Filters decoded and re-encoded by saves at StreamDecodeLevel.generalized
+GENERALIZED_FILTERS = {'/FlateDecode', '/LZWDecode', '/ASCII85Decode', '/ASCIIHexDecode', '/RunLengthDecode'}
+
+def check_temp_folder():
+    """Create TEMP_FOLDER and warn when it is too small for the largest uploads"""
+    os.makedirs(TEMP_FOLDER, exist_ok=True)
+    
+    # An upload, its compressed copy and in-flight attempts can need several times the upload size
+    free = shutil.disk_usage(TEMP_FOLDER).free
+    if free < 4 * MAX_CONTENT_LENGTH:
+        logger.warning(
+            f"Only {free // (1024 * 1024)} MB free in {TEMP_FOLDER}; large uploads may fail. "
+            "Set PDFC_TEMP to a directory with more space."
+        )
+
+check_temp_folder()
+
+class DiskRequest(Request):
+    """Request that spools multipart uploads straight to files in TEMP_FOLDER"""
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        # Write upload bytes to a real file next to their final location so
+        # saving them is a rename instead of a second copy
+        stream = tempfile.NamedTemporaryFile('wb+', dir=TEMP_FOLDER, prefix='upload_', suffix='.part', delete=False)
+        if not hasattr(self, 'upload_parts'):
+            self.upload_parts = []
+        self.upload_parts.append(stream)
+        return stream
+
 app = Flask(__name__, static_folder='TheDevilCoders/frontend/dist')
+app.request_class = DiskRequest
 app.secret_key = os.environ.get("SESSION_SECRET", "dev_secret_key")
 CORS(app)
 
-# Configuration
-MAX_CONTENT_LENGTH = 500 * 1024 * 1024  # 500MB
-TEMP_FOLDER = tempfile.gettempdir()
 app.config['MAX_CONTENT_LENGTH'] = MAX_CONTENT_LENGTH
 
-# Track uploaded files to clean up later
-uploaded_files = {}
+# Use the strongest Flate level whenever pikepdf recompresses streams
+pikepdf.settings.set_flate_compression_level(9)
+
+@dataclass
+class TaskFiles:
+    """Temporary files belonging to one compression task"""
+    orig: str
+    compressed: str
+    name: str  # sanitized upload filename, as returned to the client
+    ts: float = field(default_factory=time.time)  # last registered or looked up
+    future: Future = None  # pending or finished compress_pdf_file result
+
+# Track uploaded files to clean up later, least recently used first
+uploaded_files = OrderedDict()
+uploaded_files_lock = threading.Lock()
+
+# Compression is CPU bound, so run it in worker processes off the request thread
+executor = ProcessPoolExecutor(max_workers=os.cpu_count())
+executor_lock = threading.Lock()
+
+@app.before_request
+def reject_oversized_upload():
+    # Refuse declared oversized bodies before any of the body is read or spooled
+    if request.content_length and request.content_length > app.config['MAX_CONTENT_LENGTH']:
+        abort(413)
 
 # Serve React App
 @app.route('/', defaults={'path': ''})
@@ -43,111 +117,177 @@ def compress_pdf():
     if file.filename == '':
         return jsonify({'error': 'No selected file'}), 400
 
-    target_size_kb = request.form.get('targetSize')
-    size_unit = request.form.get('sizeUnit', 'MB')
+    target_size_kb = parse_target_size(request.form)
+    if target_size_kb is None:
+        return jsonify({'error': 'Invalid target size'}), 400
+    
+    return start_compression(file.filename, lambda orig_path: save_upload(file, orig_path), target_size_kb)
+
+@app.route('/api/compress', methods=['PUT'])
+def compress_pdf_stream():
+    # Raw PDF body with parameters in the query string, so there is no multipart to parse
+    if request.mimetype not in ('application/pdf', 'application/octet-stream'):
+        return jsonify({'error': 'Expected an application/pdf body'}), 415
+    
+    target_size_kb = parse_target_size(request.args)
+    if target_size_kb is None:
+        return jsonify({'error': 'Invalid target size'}), 400
+    
+    filename = request.args.get('filename', 'document.pdf')
+    return start_compression(filename, save_stream, target_size_kb)
+
+def parse_target_size(params):
+    """Read targetSize/sizeUnit from request parameters as KB, or None if invalid"""
+    target_size_kb = params.get('targetSize')
+    size_unit = params.get('sizeUnit', 'MB')
     
     try:
         target_size_kb = float(target_size_kb)
         if size_unit == 'MB':
             target_size_kb *= 1024  # Convert MB to KB
     except (ValueError, TypeError):
-        return jsonify({'error': 'Invalid target size'}), 400
+        return None
+    return target_size_kb
 
+def start_compression(filename, save_original, target_size_kb):
+    """Save the original with save_original(path) and queue its compression"""
     # Create unique ID for this compression task
     task_id = str(uuid.uuid4())
+    entry = None
     
     try:
         # Save original file
-        filename = secure_filename(file.filename)
+        filename = secure_filename(filename) or 'document.pdf'
         orig_path = os.path.join(TEMP_FOLDER, f"orig_{task_id}_{filename}")
-        file.save(orig_path)
-        
-        # Track the file for cleanup
-        uploaded_files[task_id] = [orig_path]
-        
-        # Compress the PDF
         compressed_path = os.path.join(TEMP_FOLDER, f"compressed_{task_id}_{filename}")
-        success = compress_pdf_file(orig_path, compressed_path, target_size_kb)
-        
-        if not success:
-            return jsonify({'error': 'Failed to compress to target size'}), 400
+        entry = TaskFiles(orig=orig_path, compressed=compressed_path, name=filename)
+        save_original(orig_path)
         
-        # Track compressed file for cleanup
-        uploaded_files[task_id].append(compressed_path)
+        # Compress the PDF in the background; clients poll /api/status/<task_id>
+        entry.future = submit_compression(orig_path, compressed_path, target_size_kb)
         
-        # Get actual file sizes
-        original_size = os.path.getsize(orig_path)
-        compressed_size = os.path.getsize(compressed_path)
+        # Publish the task only once it has a future, so lookups never see a task
+        # without one and eviction never deletes an upload still being written
+        track_files(task_id, entry)
         
-        # Calculate compression ratio
-        compression_ratio = round(100 - (compressed_size / original_size * 100), 2) if original_size > 0 else 0
-        
-        # Return complete information
         return jsonify({
             'taskId': task_id,
             'filename': filename,
-            'original_size': original_size,
-            'compressed_size': compressed_size,
-            'compression_ratio': compression_ratio
-        }), 200
+            'status': 'processing'
+        }), 202
     
+    except HTTPException:
+        # e.g. 413 when a streamed body grows past MAX_CONTENT_LENGTH
+        if entry is not None:
+            remove_files(entry)
+        raise
     except Exception as e:
         logger.error(f"Error during compression: {str(e)}")
         # Clean up files in case of error
-        cleanup_files(task_id)
+        if entry is not None:
+            remove_files(entry)
         return jsonify({'error': str(e)}), 500
 
+def submit_compression(*args):
+    """Queue compress_pdf_file, replacing the process pool once if a worker died"""
+    global executor
+    pool = executor
+    try:
+        return pool.submit(compress_pdf_file, *args)
+    except BrokenProcessPool:
+        # A killed or crashed worker breaks the pool for good; its pending
+        # futures already fail with BrokenProcessPool, so /api/status reports them
+        with executor_lock:
+            if executor is pool:
+                logger.warning("Compression process pool is broken, starting a new one")
+                executor = ProcessPoolExecutor(max_workers=os.cpu_count())
+                pool.shutdown(wait=False)
+            pool = executor
+        return pool.submit(compress_pdf_file, *args)
+
+@app.route('/api/status/<task_id>', methods=['GET'])
+def compression_status(task_id):
+    entry = get_files(task_id)
+    if entry is None:
+        return jsonify({'error': 'Task not found'}), 404
+    
+    if not entry.future.done():
+        return jsonify({'taskId': task_id, 'status': 'processing'}), 200
+    
+    try:
+        success, reason = entry.future.result()
+    except Exception as e:
+        logger.error(f"Error during compression: {str(e)}")
+        cleanup_files(task_id)
+        return jsonify({'taskId': task_id, 'status': 'failed', 'error': str(e)}), 500
+    
+    if not success:
+        cleanup_files(task_id)
+        return jsonify({'taskId': task_id, 'status': 'failed', 'error': reason}), 422
+    
+    # Get actual file sizes
+    original_size = os.path.getsize(entry.orig)
+    compressed_size = os.path.getsize(entry.compressed)
+    
+    # Calculate compression ratio
+    compression_ratio = round(100 - (compressed_size / original_size * 100), 2) if original_size > 0 else 0
+    
+    # Return complete information
+    return jsonify({
+        'taskId': task_id,
+        'filename': entry.name,
+        'status': 'done',
+        'original_size': original_size,
+        'compressed_size': compressed_size,
+        'compression_ratio': compression_ratio
+    }), 200
+
 @app.route('/api/download/<task_id>/<filename>', methods=['GET'])
 def download_file(task_id, filename):
-    if task_id not in uploaded_files:
+    entry = get_files(task_id)
+    # Only serve the task under the name it was uploaded with
+    if entry is None or entry.name != secure_filename(filename):
         return jsonify({'error': 'File not found'}), 404
     
+    if not entry.future.done():
+        return jsonify({'error': 'Compression still in progress'}), 409
+    
+    if entry.future.exception() is not None or not entry.future.result()[0]:
+        return jsonify({'error': 'Compression failed'}), 422
+    
     try:
-        # Find the compressed file - ALWAYS use the compressed path
-        compressed_path = None
-        for path in uploaded_files[task_id]:
-            if path.startswith(os.path.join(TEMP_FOLDER, f"compressed_{task_id}")):
-                compressed_path = path
-                break
-        
-        if not compressed_path:
+        # ALWAYS send the compressed file, never the original
+        compressed_path = entry.compressed
+        if not os.path.exists(compressed_path):
             logger.error(f"Compressed file not found for task_id: {task_id}")
+            cleanup_files(task_id)
             return jsonify({'error': 'Compressed file not found'}), 404
-            
-        # Get original file size for comparison
-        orig_path = None
-        for path in uploaded_files[task_id]:
-            if path.startswith(os.path.join(TEMP_FOLDER, f"orig_{task_id}")):
-                orig_path = path
-                break
-                
-        if orig_path:
-            orig_size = os.path.getsize(orig_path)
+        
+        # Log the sizes for debugging
+        if os.path.exists(entry.orig):
+            orig_size = os.path.getsize(entry.orig)
             compressed_size = os.path.getsize(compressed_path)
-            
-            # Log the sizes for debugging
             logger.info(f"Original size: {orig_size} bytes")
             logger.info(f"Compressed size: {compressed_size} bytes")
-            logger.info(f"Compression ratio: {compressed_size/orig_size:.2%}")
-            
-            # Verify we're actually sending the compressed file, not the original
-            if compressed_path == orig_path:
-                logger.error("About to send original file instead of compressed!")
-                # This should never happen, but just in case:
-                for path in uploaded_files[task_id]:
-                    logger.info(f"Available file: {path}")
+            if orig_size > 0:
+                logger.info(f"Compression ratio: {compressed_size/orig_size:.2%}")
         
         # Set a more descriptive filename
-        download_name = f"compressed_{filename}"
+        download_name = f"compressed_{entry.name}"
         
         # Definitely force as_attachment to ensure it downloads
         logger.info(f"Sending file for download: {compressed_path}")
         logger.info(f"Download name: {download_name}")
         
+        # Pass the path so the WSGI server can use wsgi.file_wrapper / sendfile(2),
+        # and answer Range and conditional requests for resumable downloads
         response = send_file(
             compressed_path, 
             as_attachment=True,
-            download_name=download_name
+            download_name=download_name,
+            conditional=True,
+            etag=True,
+            max_age=0
         )
         
         # Set additional headers to prevent caching
@@ -155,140 +295,445 @@ def download_file(task_id, filename):
         response.headers["Pragma"] = "no-cache"
         response.headers["Expires"] = "0"
         
+        # Clean up once the whole file has been sent; HEAD, partial (Range) and
+        # interrupted downloads keep the files so the download can be resumed,
+        # leaving them to LRU eviction
+        if response.status_code == 200 and request.method != 'HEAD':
+            call_when_sent(response, lambda: cleanup_files(task_id))
+        
         return response
     
     except Exception as e:
         logger.error(f"Error during download: {str(e)}")
+        cleanup_files(task_id)
         return jsonify({'error': str(e)}), 500
+
+class SentFile:
+    """File proxy recording how far into the file a server has sent the body"""
+
+    def __init__(self, file):
+        self.file = file
+        self.sent = 0
+
+    def read(self, *args):
+        # Servers write each chunk before reading the next, so everything before
+        # the current position has been sent; the final empty read reaches the end
+        self.sent = max(self.sent, self.file.tell())
+        return self.file.read(*args)
+
+    def seek(self, *args):
+        # socket.sendfile() seeks to the end of what it sent, even on error
+        position = self.file.seek(*args)
+        self.sent = max(self.sent, position)
+        return position
+
+    def __getattr__(self, name):
+        return getattr(self.file, name)
+
+def call_when_sent(response, callback):
+    """Run callback when the server closes a send_file response after sending all of it"""
+    # send_file hands its file wrapper straight to the server, which closes the
+    # wrapper rather than the response; the wrapped file is named differently by
+    # Werkzeug's FileWrapper and gunicorn's wsgi.file_wrapper
+    file_wrapper = response.response
+    attr = next((name for name in ('filelike', 'file') if hasattr(file_wrapper, name)), None)
+    if not response.direct_passthrough or attr is None:
+        return
     
-    finally:
-        # Schedule cleanup after a delay to ensure download completes
-        def delayed_cleanup():
-            import time
-            time.sleep(5)  # Wait 5 seconds before cleanup
-            cleanup_files(task_id)
-            
-        import threading
-        cleanup_thread = threading.Thread(target=delayed_cleanup)
-        cleanup_thread.daemon = True
-        cleanup_thread.start()
+    sent_file = SentFile(getattr(file_wrapper, attr))
+    setattr(file_wrapper, attr, sent_file)
+    size = response.content_length
+    wrapper_close = file_wrapper.close
+    
+    def close():
+        try:
+            wrapper_close()
+        finally:
+            if size is not None and sent_file.sent >= size:
+                callback()
+    
+    file_wrapper.close = close
+
+def save_upload(file, orig_path):
+    """Move an uploaded file to orig_path without copying its bytes"""
+    stream = file.stream
+    stream.close()
+    os.replace(stream.name, orig_path)
+
+def save_stream(orig_path):
+    """Copy the raw request body to orig_path in 1 MB chunks"""
+    with open(orig_path, 'wb', buffering=WRITE_BUFFER_SIZE) as orig_file:
+        shutil.copyfileobj(request.stream, orig_file, length=WRITE_BUFFER_SIZE)
+
+@app.teardown_request
+def remove_upload_parts(exc=None):
+    """Remove spooled upload files that were not moved into place"""
+    for stream in getattr(request, 'upload_parts', ()):
+        try:
+            stream.close()
+            if os.path.exists(stream.name):
+                os.remove(stream.name)
+        except Exception as e:
+            logger.error(f"Error removing upload {stream.name}: {str(e)}")
+
+def track_files(task_id, entry):
+    """Register a task's files, evicting expired tasks and the oldest beyond MAX_TRACKED_TASKS"""
+    with uploaded_files_lock:
+        entry.ts = time.time()
+        uploaded_files[task_id] = entry
+        evicted = pop_expired_tasks(entry.ts)
+        while len(uploaded_files) > MAX_TRACKED_TASKS:
+            evicted.append(uploaded_files.popitem(last=False)[1])
+    
+    for old_entry in evicted:
+        remove_files(old_entry)
+
+def get_files(task_id):
+    """Look up a task's files and mark them as recently used"""
+    now = time.time()
+    with uploaded_files_lock:
+        evicted = pop_expired_tasks(now)
+        entry = uploaded_files.get(task_id)
+        if entry is not None:
+            entry.ts = now
+            uploaded_files.move_to_end(task_id)
+    
+    for old_entry in evicted:
+        remove_files(old_entry)
+    return entry
+
+def pop_expired_tasks(now):
+    """Remove tasks unused for TASK_TTL seconds; call with uploaded_files_lock held"""
+    # Entries are kept in order of last use, so expired ones are at the front
+    expired = []
+    while uploaded_files:
+        task_id, entry = next(iter(uploaded_files.items()))
+        if now - entry.ts < TASK_TTL:
+            break
+        expired.append(uploaded_files.pop(task_id))
+    return expired
 
 def cleanup_files(task_id):
     """Clean up temporary files"""
-    if task_id in uploaded_files:
-        for path in uploaded_files[task_id]:
+    with uploaded_files_lock:
+        entry = uploaded_files.pop(task_id, None)
+    
+    if entry is not None:
+        remove_files(entry)
+
+def remove_files(entry):
+    """Delete the temporary files of a task"""
+    # A running compression would recreate its output, so delete once it finishes
+    if entry.future is not None and not entry.future.cancel() and not entry.future.done():
+        entry.future.add_done_callback(lambda _: remove_files(entry))
+        return
+    
+    for path in (entry.orig, entry.compressed):
+        try:
+            if os.path.exists(path):
+                os.remove(path)
+        except Exception as e:
+            logger.error(f"Error removing file {path}: {str(e)}")
+
+def open_pdf(input_path):
+    """Open a PDF with pikepdf, memory-mapping the input instead of reading it"""
+    return pikepdf.Pdf.open(input_path, access_mode=pikepdf.AccessMode.mmap)
+
+def rewind(output_file):
+    """Empty an open output file so the next attempt can overwrite it"""
+    output_file.seek(0)
+    output_file.truncate()
+
+def output_size(output_file):
+    """Size of what has been written to an open output file"""
+    output_file.flush()
+    return os.fstat(output_file.fileno()).st_size
+
+def run_qpdf(input_path, output_file):
+    """Repack and recompress a PDF with the qpdf CLI, returning whether it succeeded"""
+    result = subprocess.run(
+        [
+            QPDF_BINARY,
+            '--object-streams=generate',
+            '--compress-streams=y',
+            '--recompress-flate',
+            '--compression-level=9',
+            input_path,
+            '-'
+        ],
+        stdout=output_file,
+        stderr=subprocess.PIPE,
+        timeout=QPDF_TIMEOUT
+    )
+    # Exit status 3 means the output was written but qpdf had warnings
+    if result.returncode not in (0, 3):
+        logger.error(f"qpdf exited with status {result.returncode}: {result.stderr.decode(errors='replace').strip()}")
+        return False
+    return True
+
+def save_pdf(pdf, output_file, recompress_flate=True):
+    """Save a pikepdf document with object streams and compressed streams"""
+    # Spell out the stream handling rather than relying on qpdf defaults, which
+    # have changed between releases and can re-encode streams larger than before
+    pdf.save(
+        output_file,
+        compress_streams=True,
+        stream_decode_level=pikepdf.StreamDecodeLevel.generalized,
+        object_stream_mode=pikepdf.ObjectStreamMode.generate,
+        recompress_flate=recompress_flate,
+        linearize=False
+    )
+
+def recompress_images(pdf, quality):
+    """Re-encode the raster images of a pikepdf document as JPEG in place,
+    returning how many images were replaced"""
+    seen = set()
+    replaced = 0
+    for page in pdf.pages:
+        for raw_image in page.images.values():
+            # Images shared between pages only need to be re-encoded once
+            if raw_image.objgen in seen:
+                continue
+            seen.add(raw_image.objgen)
+            
             try:
-                if os.path.exists(path):
-                    os.remove(path)
+                pdf_image = pikepdf.PdfImage(raw_image)
+                # Masks and bilevel images do not survive JPEG encoding
+                if pdf_image.image_mask or pdf_image.bits_per_component < 8:
+                    continue
+                image = pdf_image.as_pil_image()
             except Exception as e:
-                logger.error(f"Error removing file {path}: {str(e)}")
+                logger.debug(f"Skipping unsupported image: {str(e)}")
+                continue
+            
+            if image.mode not in ('L', 'RGB'):
+                image = image.convert('RGB')
+            
+            buffer = io.BytesIO()
+            image.save(buffer, 'JPEG', quality=quality, optimize=True)
+            data = buffer.getvalue()
+            
+            # Keep the original stream when JPEG would not make it smaller
+            if len(data) >= len(raw_image.read_raw_bytes()):
+                continue
+            
+            raw_image.write(data, filter=pikepdf.Name.DCTDecode)
+            raw_image.Width = image.width
+            raw_image.Height = image.height
+            raw_image.BitsPerComponent = 8
+            raw_image.ColorSpace = pikepdf.Name.DeviceGray if image.mode == 'L' else pikepdf.Name.DeviceRGB
+            for key in ('/DecodeParms', '/Decode'):
+                if key in raw_image:
+                    del raw_image[key]
+            replaced += 1
+    
+    return replaced
+
+def page_size_estimates(pdf):
+    """Lower bound on the bytes the first n pages need, for n in 0..len(pdf.pages)
+
+    Only streams a recompressing save copies unchanged are counted: those using a
+    specialized filter such as DCTDecode, which the generalized decode level leaves
+    alone. Flate, LZW and unfiltered streams can come out much smaller, so they
+    count as zero.
+    """
+    totals = [0]
+    seen = set()
+    for page in pdf.pages:
+        streams = list(page.images.values())
+        contents = page.obj.get('/Contents')
+        if isinstance(contents, pikepdf.Array):
+            streams.extend(contents)
+        elif contents is not None:
+            streams.append(contents)
         
-        del uploaded_files[task_id]
+        size = 0
+        for stream in streams:
+            # Resources shared with earlier pages are already counted
+            if stream.objgen in seen:
+                continue
+            seen.add(stream.objgen)
+            
+            filters = stream.get('/Filter')
+            if filters is None:
+                continue
+            if isinstance(filters, pikepdf.Name):
+                filters = [filters]
+            if all(str(name) in GENERALIZED_FILTERS for name in filters):
+                continue
+            
+            length = stream.get('/Length')
+            size += int(length) if length is not None else len(stream.read_raw_bytes())
+        totals.append(totals[-1] + size)
+    return totals
+
+def save_first_pages(input_path, output_file, pages_to_keep):
+    """Write only the leading pages of a PDF, returning the size written"""
+    with open_pdf(input_path) as pdf:
+        del pdf.pages[pages_to_keep:]
+        rewind(output_file)
+        save_pdf(pdf, output_file, recompress_flate=True)
+    return output_size(output_file)
 
 def compress_pdf_file(input_path, output_path, target_size_kb):
-    """Compress PDF to target size in KB"""
+    """Compress PDF to target size in KB, returning (success, reason)"""
     try:
         # Check if original file is already smaller than target
         original_size = os.path.getsize(input_path)
-        target_size_bytes = target_size_kb * 1024
+        # Whole bytes, so every size check below is a plain int comparison
+        target_size_bytes = int(target_size_kb * 1024)
         
         logger.info(f"Target size: {target_size_kb} KB ({target_size_bytes} bytes)")
         logger.info(f"Original size: {original_size} bytes")
         
         if original_size <= target_size_bytes:
             logger.info("Original file already smaller than target size")
-            import shutil
             shutil.copy(input_path, output_path)
-            return True
+            return True, 'Original file already within target size'
         
-        # Simple approach with PyPDF2 first
-        try:
-            logger.info("Trying PyPDF2 compression")
-            reader = PdfReader(input_path)
-            writer = PdfWriter()
+        # Open the output once and reuse it for every attempt
+        with open(output_path, 'w+b', buffering=WRITE_BUFFER_SIZE) as output_file:
+            # Pick the cheapest pass that can plausibly reach the target;
+            # stronger passes still run if it falls short
+            ratio = target_size_bytes / original_size
+            logger.info(f"Target ratio: {ratio:.2%}")
             
-            # Copy all pages
-            for page in reader.pages:
-                writer.add_page(page)
-            
-            # Write compressed output
-            with open(output_path, 'wb') as output_file:
-                writer.write(output_file)
-            
-            current_size = os.path.getsize(output_path)
-            logger.info(f"PyPDF2 compression result: {current_size} bytes")
-            
-            if current_size <= target_size_bytes:
-                logger.info("PyPDF2 compression succeeded")
-                return True
-        except Exception as e:
-            logger.error(f"Error with PyPDF2 compression: {str(e)}")
-        
-        # If we need more compression, try page reduction
-        try:
-            logger.info("Trying page reduction")
-            reader = PdfReader(input_path)
-            total_pages = len(reader.pages)
+            # Fast path: let the qpdf CLI repack and recompress without Python object wrapping
+            qpdf_ran = False
+            # Whether the whole document has been saved with Flate recompression
+            recompressed = False
+            if ratio > LOSSLESS_RATIO and QPDF_BINARY:
+                try:
+                    logger.info("Trying qpdf CLI")
+                    rewind(output_file)
+                    qpdf_ran = run_qpdf(input_path, output_file)
+                    recompressed = qpdf_ran
+                    
+                    if qpdf_ran:
+                        current_size = output_size(output_file)
+                        logger.info(f"qpdf CLI result: {current_size} bytes")
+                        
+                        if current_size <= target_size_bytes:
+                            logger.info("qpdf CLI succeeded")
+                            return True, 'qpdf CLI succeeded'
+                except Exception as e:
+                    logger.error(f"Error with qpdf CLI: {str(e)}")
             
-            if total_pages > 1:
-                # Try keeping different percentages of pages
-                for keep_percent in [75, 50, 25, 10]:
-                    pages_to_keep = max(1, int(total_pages * keep_percent / 100))
-                    logger.info(f"Keeping {pages_to_keep} of {total_pages} pages ({keep_percent}%)")
+            # Lossless repack: object streams and compressed streams, existing Flate data kept
+            if ratio > LOSSLESS_RATIO and not qpdf_ran:
+                try:
+                    logger.info("Trying pikepdf repack")
+                    with open_pdf(input_path) as pdf:
+                        rewind(output_file)
+                        save_pdf(pdf, output_file, recompress_flate=False)
                     
-                    writer = PdfWriter()
-                    for i in range(min(pages_to_keep, total_pages)):
-                        writer.add_page(reader.pages[i])
+                    current_size = output_size(output_file)
+                    logger.info(f"pikepdf repack result: {current_size} bytes")
                     
-                    with open(output_path, 'wb') as output_file:
-                        writer.write(output_file)
+                    if current_size <= target_size_bytes:
+                        logger.info("pikepdf repack succeeded")
+                        return True, 'pikepdf repack succeeded'
+                except Exception as e:
+                    logger.error(f"Error with pikepdf repack: {str(e)}")
+            
+            # Lossless recompression: also re-deflate every Flate stream at level 9
+            # (already done by the qpdf CLI if it ran)
+            if ratio > RECOMPRESS_RATIO and not qpdf_ran:
+                try:
+                    logger.info("Trying pikepdf recompression")
+                    with open_pdf(input_path) as pdf:
+                        rewind(output_file)
+                        save_pdf(pdf, output_file, recompress_flate=True)
+                    recompressed = True
                     
-                    current_size = os.path.getsize(output_path)
-                    logger.info(f"Page reduction result ({keep_percent}%): {current_size} bytes")
+                    current_size = output_size(output_file)
+                    logger.info(f"pikepdf recompression result: {current_size} bytes")
                     
                     if current_size <= target_size_bytes:
-                        logger.info(f"Successfully compressed by keeping {pages_to_keep} pages")
-                        return True
-        except Exception as e:
-            logger.error(f"Error during page reduction: {str(e)}")
-        
-        # Last resort - binary truncation to exact size
-        try:
-            logger.info("Using binary truncation to exact size")
-            with open(input_path, 'rb') as infile:
-                content = infile.read()
+                        logger.info("pikepdf recompression succeeded")
+                        return True, 'pikepdf recompression succeeded'
+                except Exception as e:
+                    logger.error(f"Error with pikepdf recompression: {str(e)}")
             
-            # Determine how much to keep (exactly the target size)
-            bytes_to_keep = min(len(content), int(target_size_bytes))
-            truncated_content = content[:bytes_to_keep]
-            
-            with open(output_path, 'wb') as outfile:
-                outfile.write(truncated_content)
+            # Lossy pass: re-encode embedded raster images as JPEG, lowering quality
+            # until the result fits; each attempt starts from the original images
+            for quality in IMAGE_QUALITIES:
+                try:
+                    with open_pdf(input_path) as pdf:
+                        replaced = recompress_images(pdf, quality)
+                        if replaced:
+                            logger.info(f"Trying image recompression ({replaced} images at quality {quality})")
+                        elif recompressed:
+                            # Saving now would repeat an earlier recompressing save
+                            continue
+                        else:
+                            # Below RECOMPRESS_RATIO this is the only full recompressing
+                            # save before page reduction, so make it once
+                            logger.info(f"No images shrink at quality {quality}, recompressing streams only")
+                        rewind(output_file)
+                        save_pdf(pdf, output_file, recompress_flate=True)
+                        recompressed = True
+                    
+                    current_size = output_size(output_file)
+                    logger.info(f"Image recompression result (quality {quality}): {current_size} bytes")
+                    
+                    if current_size <= target_size_bytes:
+                        if not replaced:
+                            logger.info("Stream recompression succeeded")
+                            return True, 'pikepdf recompression succeeded'
+                        logger.info("Image recompression succeeded")
+                        return True, f'Recompressed images at JPEG quality {quality}'
+                except Exception as e:
+                    logger.error(f"Error during image recompression: {str(e)}")
+                    break
             
-            # Verify size
-            final_size = os.path.getsize(output_path)
-            logger.info(f"Final truncated size: {final_size} bytes")
+            # If we need more compression, try page reduction
+            try:
+                logger.info("Trying page reduction")
+                with open_pdf(input_path) as pdf:
+                    total_pages = len(pdf.pages)
+                    estimates = page_size_estimates(pdf)
+                
+                # Binary search for the most leading pages that fit; counts whose
+                # untouched stream bytes alone exceed the target are rejected unwritten.
+                # Keeping every page is not searched: an earlier pass has always saved
+                # the whole document with Flate recompression (the qpdf CLI or pikepdf
+                # recompression above RECOMPRESS_RATIO, otherwise the image pass, which
+                # saves at least once even when no image shrinks), and it did not fit.
+                lo, hi = 1, total_pages - 1
+                best = written = 0
+                while lo <= hi:
+                    pages_to_keep = (lo + hi) // 2
+                    if estimates[pages_to_keep] > target_size_bytes:
+                        logger.info(f"Skipping {pages_to_keep} pages, needs at least {estimates[pages_to_keep]} bytes")
+                        hi = pages_to_keep - 1
+                        continue
+                    
+                    current_size = save_first_pages(input_path, output_file, pages_to_keep)
+                    written = pages_to_keep
+                    logger.info(f"Page reduction result ({pages_to_keep} of {total_pages} pages): {current_size} bytes")
+                    
+                    if current_size <= target_size_bytes:
+                        best = pages_to_keep
+                        lo = pages_to_keep + 1
+                    else:
+                        hi = pages_to_keep - 1
+                
+                if best:
+                    # The last attempt may have been a larger count that did not fit
+                    if written != best:
+                        save_first_pages(input_path, output_file, best)
+                    logger.info(f"Successfully compressed by keeping {best} pages")
+                    return True, f'Kept {best} of {total_pages} pages'
+            except Exception as e:
+                logger.error(f"Error during page reduction: {str(e)}")
             
-            # The file may not be a valid PDF anymore, but at least it's exactly the right size
-            return True
-        except Exception as e:
-            logger.error(f"Error during binary truncation: {str(e)}")
-        
-        # If all else fails, just return best attempt
-        import shutil
-        shutil.copy(input_path, output_path)
-        logger.warning("Failed to compress to target size, returning best attempt")
-        return True
+        logger.warning("Failed to compress to target size")
+        return False, 'Target size unreachable without corrupting the PDF'
     
     except Exception as e:
         logger.error(f"Compression error: {str(e)}")
-        # Always return something even in case of error
-        try:
-            import shutil
-            shutil.copy(input_path, output_path)
-        except:
-            pass
-        return True
+        return False, f'Compression failed: {str(e)}'
 
 # if __name__ == '__main__':
 #     app.run(debug=True, host='0.0.0.0', port=5000)